@@ -1,23 +1,51 @@
-import argparse
 import os
-from sqlalchemy import all_
-from tqdm import tqdm 
 import torch
 import numpy as np
-import json 
 import copy 
-import os.path as osp
-import math
+from itertools import chain
 
+import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim import lr_scheduler
+import torch.multiprocessing as mp
 
-from cutsel_agent_parallel import CutSelectAgent, HierarchyCutSelectAgent
+from cutsel_agent_parallel import CutSelectAgent
 from logger import logger
 
-from utils import setup_logger, create_stats_ordered_dict, set_global_seed
+from utils import create_stats_ordered_dict, set_global_seed
 from utilss.mean_std import RunningMeanStd
 
+_OPTIMIZERS = {
+    'Adam': optim.Adam,
+    'AdamW': optim.AdamW,
+    'SGD': optim.SGD,
+    'RMSprop': optim.RMSprop
+}
+
+def evaluate_worker(return_queue,env,policy,sel_cuts_percent,evaluate_decode_type,num_samples,seed,mean_std,policy_type):
+    # the policy is a cpu copy, cuda state is never shared with the worker
+    _ = set_global_seed(seed%4096)
+    env.set_seed(seed)
+    neg_solving_time = np.zeros((num_samples, 1))
+    neg_total_nodes = np.zeros((num_samples, 1))
+    for i in range(num_samples):
+        env.reset()
+        cutsel_agent = CutSelectAgent(
+            env.m,
+            policy,
+            None,
+            sel_cuts_percent,
+            'cpu',
+            evaluate_decode_type,
+            mean_std,
+            policy_type
+        )
+        env_step_info = env.step(cutsel_agent)
+        neg_solving_time[i,:] = env_step_info['solving_time']
+        neg_total_nodes[i,:] = env_step_info['ntotal_nodes']
+        cutsel_agent.free_problem()
+    return_queue.put((neg_solving_time, neg_total_nodes))
+
 class ReinforceBaselineAlg():
     def __init__(
         self,
@@ -45,7 +73,12 @@ class ReinforceBaselineAlg():
         lr_decay_step=5,
         lr_decay_rate=0.96,
         normalize=False,
-        normalize_reward=True
+        normalize_reward=True,
+        reward_ema_alpha=0.99,
+        policy_type='no_token',
+        compile_nets=False,
+        mixed_precision=True,
+        debug=False
     ):
         self.env = env
         self.pointer_net = pointer_net
@@ -57,7 +90,7 @@ class ReinforceBaselineAlg():
         self.num_epochs = num_epochs
         self.max_grad_norm = max_grad_norm
         self.batch_size = batch_size
-        self.device = device
+        self.device = torch.device(device)
         self.reward_type = reward_type
         self.train_steps_per_epoch = train_steps_per_epoch
 
@@ -68,15 +101,19 @@ class ReinforceBaselineAlg():
         # evaluate 
         self.evaluate_freq = evaluate_freq
         self.evaluate_samples = evaluate_samples
+        self.policy_type = policy_type
         
         # optimizer
         if isinstance(optimizer_class, str):
-            optimizer_class = eval('optim.'+optimizer_class)
-            self.optimizer_class = optimizer_class
+            if optimizer_class not in _OPTIMIZERS:
+                raise ValueError(f"unknown optimizer_class: {optimizer_class}, expected one of {list(_OPTIMIZERS.keys())}")
+            optimizer_class = _OPTIMIZERS[optimizer_class]
+        self.optimizer_class = optimizer_class
         
         self.policy_optimizer = optimizer_class(
             self.pointer_net.parameters(),
-            lr=self.actor_net_lr
+            lr=self.actor_net_lr,
+            **self._optimizer_kwargs(self.pointer_net)
         )
 
         self.baseline_type = baseline_type
@@ -85,9 +122,9 @@ class ReinforceBaselineAlg():
             # using critic net as a baseline function
             self.value_optimizer = optimizer_class(
                 self.value_net.parameters(),
-                lr=self.critic_net_lr
+                lr=self.critic_net_lr,
+                **self._optimizer_kwargs(self.value_net)
             )
-            self.critic_mse = torch.nn.MSELoss()
         elif self.baseline_type == 'simple':
             self.critic_exp_mvg_avg = torch.zeros(1)
             # .to(self.device)
@@ -110,34 +147,73 @@ class ReinforceBaselineAlg():
             self.mean_std = RunningMeanStd(feature_shape)
 
         self.normalize_reward = normalize_reward
+        self.reward_ema_alpha = reward_ema_alpha
+        self.reward_ema_mean = 0.
+        self.reward_ema_sq = 0.
+        self.reward_ema_count = 0
+        # compiled training forwards, the nets themselves stay plain nn.Modules
+        # so that checkpoints and the copies sent to sampling workers are unchanged
+        self.compile_nets = compile_nets
+        self._policy_logprobs = self._maybe_compile(self.pointer_net.batch_logprobs)
+        if self.baseline_type == 'net':
+            self._value_forward = self._maybe_compile(self.value_net.forward)
+        # bf16 autocast for the training forwards, only on cuda devices that support it
+        self.mixed_precision = mixed_precision and self.device.type == 'cuda' \
+            and torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        # log cuda memory while training
+        self.debug = debug
+
+    def _optimizer_kwargs(self, net):
+        # update all parameters with one fused (cuda Adam) or multi-tensor kernel;
+        # fused Adam needs the parameters on cuda when it is constructed
+        if self.optimizer_class is optim.Adam and all(p.is_cuda for p in net.parameters()):
+            return {'fused': True}
+        return {'foreach': True}
+
+    def _maybe_compile(self, fn):
+        if self.compile_nets and torch.cuda.is_available() and hasattr(torch, 'compile'):
+            # train and evaluate minibatches need separate shape buckets
+            torch._dynamo.config.cache_size_limit = 64
+            return torch.compile(fn, backend="inductor", dynamic=True, fullgraph=False)
+        return fn
+
+    def _autocast(self):
+        # backward and optimizer steps stay outside, on the fp32 weights
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.mixed_precision)
 
     def _prob_to_logp(self, prob):
-        logprob = 0
-        for p in prob:
-            logp = torch.log(p)
-            logprob += logp
+        # prob: list of [batch_size] tensors, one per decoding step
+        logprob = torch.log(torch.stack(list(prob))).sum(0)
         # logprob[(logprob < -10000).detach()] = 0.
         
         return logprob
 
     def evaluate(self, epoch):
         logger.log(f"evaluating...  epoch: {epoch}")
-        neg_solving_time = np.zeros((1, self.evaluate_samples))
-        neg_total_nodes = np.zeros((1, self.evaluate_samples))
-        for i in range(self.evaluate_samples):
-            self.env.reset()
-            cutsel_agent = CutSelectAgent(
-                self.env.m,
-                self.pointer_net,
-                self.value_net,
-                self.sel_cuts_percent,
-                self.device,
-                self.evaluate_decode_type,
-                self.baseline_type
+        # episodes are independent, so split them over cpu worker processes
+        num_workers = min(self.evaluate_samples, os.cpu_count() or 1)
+        if num_workers <= 0:
+            return
+        samples_each_worker = [len(idxes) for idxes in np.array_split(np.arange(self.evaluate_samples), num_workers)]
+        seeds = [np.random.randint(2 ** 30) for _ in range(num_workers)]
+        for i, s in enumerate(seeds):
+            logger.record_tabular(f'evaluating/{i+1}th process seed', s)
+        policy = copy.deepcopy(self.pointer_net).to('cpu')
+        mean_std = self.mean_std if self.normalize else None
+        return_queue = mp.SimpleQueue()
+        processes = []
+        for num_samples, seed in zip(samples_each_worker, seeds):
+            p = mp.Process(
+                target=evaluate_worker,
+                args=(return_queue,self.env,policy,self.sel_cuts_percent,self.evaluate_decode_type,num_samples,seed,mean_std,self.policy_type)
             )
-            env_step_info = self.env.step(cutsel_agent)
-            neg_solving_time[:,i] = env_step_info['solving_time']
-            neg_total_nodes[:,i] = env_step_info['ntotal_nodes']
+            p.start()
+            processes.append(p)
+        evaluate_results = [return_queue.get() for p in processes] # list of tuple
+        for p in processes:
+            p.join()
+        neg_solving_time = np.vstack([result[0] for result in evaluate_results])
+        neg_total_nodes = np.vstack([result[1] for result in evaluate_results])
         logger.record_tabular('evaluating/Neg Solving time', np.mean(neg_solving_time))
         logger.record_tabular('evaluating/Neg Total Nodes', np.mean(neg_total_nodes))
 
@@ -152,11 +228,10 @@ class ReinforceBaselineAlg():
         logger.save_itr_params(epoch, state_dict)
 
     def _process_env_info(self, env_step_infos):
-        env_info = {}
-        for k in env_step_infos[0].keys():
-            env_info[k] = []
-            for info in env_step_infos:
-                env_info[k].extend(info[k])
+        keys = list(env_step_infos[0].keys())
+        env_info = {
+            k: list(chain.from_iterable(info[k] for info in env_step_infos)) for k in keys
+        }
 
         return env_info
 
@@ -167,6 +242,11 @@ class ReinforceBaselineAlg():
 
         return (state - mean) / (std+epsilon)
 
+    def _split_stacked_states(self, stack_states, states):
+        # split [total cuts num x feature_dim] back into per state arrays (views)
+        offsets = np.cumsum([len(state) for state in states])[:-1]
+        return np.split(stack_states, offsets, axis=0)
+
     def _process_data(self, raw_results):
         env_step_infos = [result[0] for result in raw_results]
         training_datasets = [result[1] for result in raw_results] # list of dict 
@@ -174,7 +254,6 @@ class ReinforceBaselineAlg():
         actions = []
         sel_cuts_nums = []
         neg_rewards = []
-        new_step_infos = {}
         for dict_data in training_datasets:
             states.extend(dict_data['state']) # list of numpy
             actions.extend(dict_data['action']) # list of list
@@ -182,44 +261,76 @@ class ReinforceBaselineAlg():
             neg_rewards.extend(dict_data['neg_reward'])
         print(f"debug log neg_rewards: {neg_rewards}")
         print(f"debug log states len: {len(states)}")
-        neg_rewards = np.vstack(neg_rewards)
+        neg_rewards = np.asarray(neg_rewards, dtype=np.float64).reshape(-1, 1)
         neg_rewards = self.reward_scale * neg_rewards
         if self.normalize_reward:
             # log raw neg rewards
             logger.record_dict(create_stats_ordered_dict('training/Nonnormalize Neg Reward', neg_rewards))
-            neg_rewards_mean = np.mean(neg_rewards)
-            neg_rewards_std = np.std(neg_rewards)
-            neg_rewards = (neg_rewards - neg_rewards_mean) / (neg_rewards_std + 1e-3)
-
-        for k in env_step_infos[0].keys():
-            new_step_infos[k] = []
-        for step_info in env_step_infos:
-            for k in step_info.keys():
-                new_step_infos[k].extend(step_info[k])
+            # exponential moving average of the first two moments across epochs
+            alpha = self.reward_ema_alpha
+            self.reward_ema_mean = alpha * self.reward_ema_mean + (1. - alpha) * np.mean(neg_rewards)
+            self.reward_ema_sq = alpha * self.reward_ema_sq + (1. - alpha) * np.mean(neg_rewards ** 2)
+            self.reward_ema_count += 1
+            bias_correction = 1. - alpha ** self.reward_ema_count
+            neg_rewards_mean = self.reward_ema_mean / bias_correction
+            neg_rewards_sq = self.reward_ema_sq / bias_correction
+            neg_rewards_std = np.sqrt(max(neg_rewards_sq - neg_rewards_mean ** 2, 0.) + 1e-8)
+            neg_rewards = (neg_rewards - neg_rewards_mean) / neg_rewards_std
+
+        new_step_infos = self._process_env_info(env_step_infos)
         if self.normalize:
             # update mean_std
             logger.log("normalizing data .....")
-            stack_states = np.vstack(states)
+            stack_states = np.ascontiguousarray(np.concatenate(states, axis=0))
             self.mean_std.update(stack_states)
             # log non-normalize states
             feature_len = stack_states.shape[1]
             for i in range(feature_len):
-                logger.record_dict(create_stats_ordered_dict(f'training/cut {i+1} th non-normalize feature', stack_states[:,i:i+1]))
-            # normalize states
-            normalize_states = [self._normalize_state(state) for state in states]
-            return neg_rewards, normalize_states, actions, sel_cuts_nums, new_step_infos
-
-        return neg_rewards, states, actions, sel_cuts_nums, new_step_infos
+                logger.record_dict(create_stats_ordered_dict(f'training/cut {i+1} th non-normalize feature', stack_states[:,i]))
+            # normalize all cuts as one matrix op, then split back per state
+            stack_states = self._normalize_state(stack_states)
+            normalize_states = self._split_stacked_states(stack_states, states)
+            return neg_rewards, normalize_states, actions, sel_cuts_nums, new_step_infos, stack_states
+
+        return neg_rewards, states, actions, sel_cuts_nums, new_step_infos, None
+
+    def _to_device(self, array):
+        # async H2D copy from pinned host memory
+        tensor = torch.from_numpy(array)
+        if self.device.type == 'cuda':
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def _collate_states(self, states):
+        lengths = np.array([state.shape[0] for state in states], dtype=np.int64)
+        # pad variable length cut sequences to [max cuts num x batch_size x feature_dim]
+        states_padded = np.zeros((lengths.max(), len(states), states[0].shape[1]), dtype=np.float32)
+        for b, state in enumerate(states):
+            states_padded[:lengths[b], b] = state
+
+        return self._to_device(states_padded), torch.from_numpy(lengths)
+
+    def _collate_minibatch(self, states, actions, sel_cuts_nums):
+        states_padded, lengths = self._collate_states(states)
+        # pad selected idxes to [max sel cuts num x batch_size]
+        actions_padded = np.zeros((max(len(action) for action in actions), len(actions)), dtype=np.int64)
+        for b, action in enumerate(actions):
+            actions_padded[:len(action), b] = action
+        sel_cuts_nums_t = np.asarray(sel_cuts_nums, dtype=np.int64)
+
+        return (
+            states_padded,
+            lengths,
+            self._to_device(sel_cuts_nums_t),
+            self._to_device(actions_padded)
+        )
 
     def _compute_sm_entropy(self, probs):
-        probs = torch.squeeze(probs)
-        entropy = 0
-        for prob in probs:
-            entropy -= prob * torch.log(prob)
-        return entropy
+        # probs: [sourceL], entr computes -p*log(p) and is 0 at p=0
+        return torch.special.entr(probs).sum()
 
     def train(self, raw_results, epoch):
-        neg_rewards, states, actions, sel_cuts_nums, env_step_infos = self._process_data(raw_results)
+        neg_rewards, states, actions, sel_cuts_nums, env_step_infos, stack_states = self._process_data(raw_results)
         # states to torch
         ### compute policy gradient 
         # compute baseline function 
@@ -237,6 +348,9 @@ class ReinforceBaselineAlg():
             else:
                 self.critic_exp_mvg_avg = (self.critic_exp_mvg_avg * self.critic_beta) + ((1. - self.critic_beta) * neg_rewards.mean())
 
+        # move the whole epoch's rewards to the device once and slice per minibatch
+        neg_rewards_t = torch.as_tensor(neg_rewards, dtype=torch.float32, device=self.device)
+        num_dropped = 0
         for i in range(train_loop):
             if i == (train_loop - 1):
                 batch_size = len(states[i*self.batch_size:])
@@ -244,43 +358,36 @@ class ReinforceBaselineAlg():
                 batch_size = self.batch_size
             logger.log(f"training epoch: {epoch}, training loop: {train_loop}")
             log_prefix = f"training epoch: {epoch}, training loop: {train_loop}"
-            logprobs = torch.zeros((batch_size, 1)).to(self.device)
-            if self.baseline_type == 'net':
-                neg_baseline_value = torch.zeros((batch_size, 1)).to(self.device)
-            for j in range(batch_size):
-                logger.log(f"{log_prefix} step {j}: cuda memory: {torch.cuda.memory_allocated(0)/1024**3} GB")
-                logger.log(f"{log_prefix} step {j}: cuda cached: {torch.cuda.memory_cached(0)/1024**3} GB")
-                if (torch.cuda.memory_cached(0)/1024**3) > 4.5:
-                    # empty torch cache
-                    torch.cuda.empty_cache()
-                cur_index = int(i * self.batch_size + j)
-                state = torch.from_numpy(states[cur_index]).float().to(self.device)
-                state = state.reshape(state.shape[0], 1, state.shape[1])
-                action = actions[cur_index]
-                sel_cuts_num = sel_cuts_nums[cur_index]
-                pointer_probs, logprob = self.pointer_net.logprobs(
-                    state, sel_cuts_num, action
+            if self.debug:
+                logger.log(f"{log_prefix}: cuda memory: {torch.cuda.memory_allocated(0)/1024**3} GB")
+                logger.log(f"{log_prefix}: cuda reserved: {torch.cuda.memory_reserved(0)/1024**3} GB")
+            st_index = i * self.batch_size
+            states_padded, lengths, sel_cuts_nums_t, actions_padded = self._collate_minibatch(
+                states[st_index:st_index+batch_size],
+                actions[st_index:st_index+batch_size],
+                sel_cuts_nums[st_index:st_index+batch_size]
+            )
+            # pointer_probs: [batch_size x max sel cuts num x max cuts num]
+            with self._autocast():
+                pointer_probs, logprobs = self._policy_logprobs(
+                    states_padded, lengths, sel_cuts_nums_t, actions_padded
                 )
-                if logprob.item() < -4000:
-                    logprobs[j,:] = logprob.detach()
-                    logger.log('warning: logprob too small, we drop it!!!')
-                else:
-                    logprobs[j,:] = logprob
                 if self.baseline_type == 'net':
-                    neg_baseline_value[j,:] = self.value_net(state).squeeze()
-                if i == 0 and j == 0:
-                    # log tensorboard 
-                    logger.tb_logger.add_histogram("selected_idxes", np.array(action), global_step=epoch)
-                    for pos, prob_distribution in enumerate(pointer_probs):   
-                        logger.tb_logger.add_histogram(f"position {pos} probability distribution", prob_distribution, global_step=epoch)
-            pos_1_entropy = self._compute_sm_entropy(pointer_probs[0])
+                    neg_baseline_value = self._value_forward(states_padded, lengths)
+            # losses and advantages are computed in fp32
+            pointer_probs, logprobs = pointer_probs.float(), logprobs.float()
+            if self.baseline_type == 'net':
+                neg_baseline_value = neg_baseline_value.float()
+            # drop too small logprobs without syncing with the device
+            too_small = logprobs.detach() < -4000
+            num_dropped = num_dropped + too_small.sum()
+            logprobs = torch.where(too_small, logprobs.detach(), logprobs)
+            # padded positions have probability 0 and contribute nothing to the entropy
+            pos_1_entropy = self._compute_sm_entropy(pointer_probs[0, 0])
             logger.record_tabular('pos_1_entropy', pos_1_entropy.item())
 
-            if i == (train_loop - 1) :
-                minibatch_neg_rewards = torch.from_numpy(neg_rewards[i*self.batch_size:]).float().to(self.device)
-            else:
-                minibatch_neg_rewards = torch.from_numpy(neg_rewards[i*self.batch_size:(i+1)*self.batch_size]).float().to(self.device)
-            
+            minibatch_neg_rewards = neg_rewards_t[st_index:st_index+batch_size]
+
             if self.baseline_type == 'simple':
                 neg_advantage = minibatch_neg_rewards - torch.tensor([self.critic_exp_mvg_avg], dtype=torch.float, device=self.device)
             elif self.baseline_type == 'no_baseline':
@@ -288,29 +395,38 @@ class ReinforceBaselineAlg():
             elif self.baseline_type == 'net':
                 neg_advantage = minibatch_neg_rewards - neg_baseline_value.detach()
             # compute policy loss
-            reinforce_loss = (neg_advantage * logprobs).mean()
+            reinforce_loss = torch.dot(neg_advantage.view(-1), logprobs.view(-1)) / neg_advantage.numel()
             self.policy_optimizer.zero_grad()
             reinforce_loss.backward() # compute gradient
             # clip gradient norms
-            torch.nn.utils.clip_grad_norm(self.pointer_net.parameters(),
-                    float(self.max_grad_norm), norm_type=2)            
+            torch.nn.utils.clip_grad_norm_(self.pointer_net.parameters(),
+                    float(self.max_grad_norm), norm_type=2, error_if_nonfinite=False)            
             self.policy_optimizer.step()
             # compute value loss 
             if self.baseline_type == 'net':
-                critic_loss = self.critic_mse(neg_baseline_value, minibatch_neg_rewards)
+                critic_loss = F.mse_loss(neg_baseline_value, minibatch_neg_rewards)
                 self.value_optimizer.zero_grad()
                 critic_loss.backward()
-                torch.nn.utils.clip_grad_norm(self.value_net.parameters(),
-                        float(self.max_grad_norm), norm_type=2)  
+                torch.nn.utils.clip_grad_norm_(self.value_net.parameters(),
+                        float(self.max_grad_norm), norm_type=2, error_if_nonfinite=False)  
                 self.value_optimizer.step()
 
-            torch.cuda.empty_cache()
         # lr update
         if self.lr_decay:
             self.policy_lr_scheduler.step()
             logger.log(f"epoch: {epoch}, policy optimizer lr: {self.policy_optimizer.param_groups[0]['lr']}")
         # save model            
         self.save_checkpoint(epoch)
+        # release torch cuda cache once per epoch
+        torch.cuda.empty_cache()
+
+        # log tensorboard once per epoch, outside the minibatch loop
+        logger.tb_logger.add_histogram("selected_idxes", np.concatenate(actions), global_step=epoch)
+        # the end token net puts the end token right after the valid cuts
+        num_candidates = int(lengths[0]) + (1 if self.policy_type == 'with_token' else 0)
+        first_probs = pointer_probs[0, :sel_cuts_nums[st_index], :num_candidates].detach().cpu()
+        for pos, prob_distribution in enumerate(first_probs):
+            logger.tb_logger.add_histogram(f"position {pos} probability distribution", prob_distribution, global_step=epoch)
 
         # log data
         logger.tb_logger.add_histogram("neg_rewards", neg_rewards, global_step=epoch)
@@ -320,6 +436,7 @@ class ReinforceBaselineAlg():
         logger.record_tabular('training/Neg Advantage', neg_advantage.mean().item())
         logger.record_dict(create_stats_ordered_dict('training/logprobs',logprobs.cpu().detach().numpy()))
         logger.record_tabular('training/reinforce loss', reinforce_loss.item())
+        logger.record_tabular('training/dropped logprobs', int(num_dropped))
         logger.record_tabular('training/Critic Value', self.critic_exp_mvg_avg.item())
         if self.baseline_type == 'net':
             logger.record_tabular('training/Critic Loss', critic_loss.item())
@@ -327,9 +444,12 @@ class ReinforceBaselineAlg():
         
         # log states
         logger.record_dict(create_stats_ordered_dict('training/len cuts', [len(state) for state in states]))
-        feature_len = states[0].shape[1]
+        # reuse the (normalized) stack from _process_data, only stack here when normalize is off
+        if stack_states is None:
+            stack_states = np.concatenate(states, axis=0)
+        feature_len = stack_states.shape[1]
         for i in range(feature_len):
-            logger.record_dict(create_stats_ordered_dict(f'training/cut {i+1} th feature', np.vstack([state[:,i:i+1] for state in states])))
+            logger.record_dict(create_stats_ordered_dict(f'training/cut {i+1} th feature', stack_states[:,i]))
         logger.record_dict(create_stats_ordered_dict('training/sel cuts num', sel_cuts_nums))
 
         stats = {}
@@ -393,9 +513,11 @@ class HRLReinforceAlg(ReinforceBaselineAlg):
 
         self.highlevel_actor_lr = highlevel_actor_lr
         self.cutsel_percent_policy = cutsel_percent_policy
+        self._highlevel_log_prob = self._maybe_compile(self.cutsel_percent_policy.log_prob)
         self.cutsel_percent_policy_optimizer = self.optimizer_class(
             self.cutsel_percent_policy.parameters(),
-            lr=self.highlevel_actor_lr
+            lr=self.highlevel_actor_lr,
+            **self._optimizer_kwargs(self.cutsel_percent_policy)
         )
         if self.lr_decay:
             self.cutsel_percent_policy_lr_scheduler = lr_scheduler.StepLR(
@@ -464,14 +586,14 @@ class HRLReinforceAlg(ReinforceBaselineAlg):
         if self.normalize:
             # update mean_std
             logger.log("normalizing data .....")
-            stack_states = np.vstack(states)
+            stack_states = np.ascontiguousarray(np.concatenate(states, axis=0))
             self.mean_std.update(stack_states)
             # log non-normalize states
             # feature_len = stack_states.shape[1]
             # for i in range(feature_len):
             #     logger.record_dict(create_stats_ordered_dict(f'training/cut {i+1} th non-normalize feature', stack_states[:,i:i+1]))
             # normalize states
-            states = [self._normalize_state(state) for state in states]
+            states = self._split_stacked_states(self._normalize_state(stack_states), states)
 
         total_num_samples = len(states)
         if total_num_samples < self.train_highlevel_batch_size:
@@ -485,7 +607,13 @@ class HRLReinforceAlg(ReinforceBaselineAlg):
             self.critic_exp_mvg_avg_high_level = neg_rewards.mean()
         else:
             self.critic_exp_mvg_avg_high_level = (self.critic_exp_mvg_avg_high_level * self.critic_beta) + ((1. - self.critic_beta) * neg_rewards.mean())
+        neg_rewards_t = torch.as_tensor(neg_rewards, dtype=torch.float32, device=self.device)
+        # move the whole high level dataset to the device once, minibatches are views
+        # states_t: [max cuts num x total_num_samples x feature_dim], actions_t: [total_num_samples x 1]
+        states_t, lengths = self._collate_states(states)
+        actions_t = self._to_device(np.asarray(actions, dtype=np.float32).reshape(-1, 1))
         infos = {}
+        num_dropped = 0
         for i in range(train_loop):
             if i == (train_loop - 1):
                 batch_size = len(states[i*self.train_highlevel_batch_size:])
@@ -493,47 +621,45 @@ class HRLReinforceAlg(ReinforceBaselineAlg):
                 batch_size = self.train_highlevel_batch_size
             logger.log(f"training epoch: {self.train_highlevel_epoch}, training loop: {i}/{train_loop}")
             log_prefix = f"training epoch: {self.train_highlevel_epoch}, training loop: {i}/{train_loop}"
-            logprobs = torch.zeros((batch_size, 1)).to(self.device)
-            for j in range(batch_size):
-                logger.log(f"{log_prefix} step {j}: cuda memory: {torch.cuda.memory_allocated(0)/1024**3} GB")
-                logger.log(f"{log_prefix} step {j}: cuda cached: {torch.cuda.memory_cached(0)/1024**3} GB")
-                cur_index = int(i * self.train_highlevel_batch_size + j)
-                state = torch.from_numpy(states[cur_index]).float().to(self.device)
-                state = state.reshape(state.shape[0], 1, state.shape[1])
-                action = torch.tensor(actions[cur_index], dtype=torch.float, device=self.device)
-
-                logprob, info = self.cutsel_percent_policy.log_prob(state, action=action)
-                if logprob.item() < -1e5:
-                    logprobs[j,:] = logprob.detach()
-                    logger.log('warning: high level policy logprob too small, we detach it to drop it!!!')
-                else:
-                    logprobs[j,:] = logprob
-                    
-                if i == 0 and j == 0:
-                    for k in info.keys():
-                        infos[k] = []
-                for k in info.keys():
-                    infos[k].append(info[k].item())
-
-            if i == (train_loop - 1) :
-                minibatch_neg_rewards = torch.from_numpy(neg_rewards[i*self.train_highlevel_batch_size:]).float().to(self.device)
-            else:
-                minibatch_neg_rewards = torch.from_numpy(neg_rewards[i*self.train_highlevel_batch_size:(i+1)*self.train_highlevel_batch_size]).float().to(self.device)
-            
+            if self.debug:
+                logger.log(f"{log_prefix}: cuda memory: {torch.cuda.memory_allocated(0)/1024**3} GB")
+                logger.log(f"{log_prefix}: cuda reserved: {torch.cuda.memory_reserved(0)/1024**3} GB")
+            st_index = i * self.train_highlevel_batch_size
+            minibatch_lengths = lengths[st_index:st_index+batch_size]
+            minibatch_states = states_t[:int(minibatch_lengths.max()), st_index:st_index+batch_size]
+            # saturated tanh actions (|a| = 1) have an infinite pretanh action; evaluate them
+            # at 0 and drop them, so that no inf enters the shared autograd graph
+            minibatch_actions = actions_t[st_index:st_index+batch_size]
+            saturated = minibatch_actions.abs() >= 1
+            with self._autocast():
+                logprobs_raw, info = self._highlevel_log_prob(
+                    minibatch_states,
+                    action=torch.where(saturated, torch.zeros_like(minibatch_actions), minibatch_actions),
+                    lengths=minibatch_lengths
+                )
+            logprobs_raw = logprobs_raw.float().view(-1, 1)
+            for k in info.keys():
+                infos.setdefault(k, []).append(info[k].detach().float().view(-1))
+            # drop too small logprobs without syncing with the device
+            too_small = saturated | (logprobs_raw.detach() < -1e5)
+            num_dropped = num_dropped + too_small.sum()
+            logprobs = torch.where(too_small, logprobs_raw.detach(), logprobs_raw)
+
+            minibatch_neg_rewards = neg_rewards_t[st_index:st_index+batch_size]
+
             if self.baseline_type == 'simple':
                 neg_advantage = minibatch_neg_rewards - torch.tensor([self.critic_exp_mvg_avg_high_level], dtype=torch.float, device=self.device)
             else:
                 neg_advantage = minibatch_neg_rewards
             
-            reinforce_loss = (neg_advantage * logprobs).mean()
+            reinforce_loss = torch.dot(neg_advantage.view(-1), logprobs.view(-1)) / neg_advantage.numel()
             self.cutsel_percent_policy_optimizer.zero_grad()
             reinforce_loss.backward() # compute gradient
             # clip gradient norms
-            torch.nn.utils.clip_grad_norm(self.cutsel_percent_policy.parameters(),
-                    float(self.max_grad_norm), norm_type=2)            
+            torch.nn.utils.clip_grad_norm_(self.cutsel_percent_policy.parameters(),
+                    float(self.max_grad_norm), norm_type=2, error_if_nonfinite=False)            
             self.cutsel_percent_policy_optimizer.step()
 
-            torch.cuda.empty_cache()
         # lr update
         if self.lr_decay:
             self.cutsel_percent_policy_lr_scheduler.step()
@@ -547,11 +673,12 @@ class HRLReinforceAlg(ReinforceBaselineAlg):
         stats.update(create_stats_ordered_dict(f'{Prefix}/logprobs', logprobs.cpu().detach().numpy()))
         stats.update(create_stats_ordered_dict(f'{Prefix}/cut_percent_actions', actions))
         stats[f'{Prefix}/reinforce loss'] = reinforce_loss.item()
+        stats[f'{Prefix}/dropped logprobs'] = int(num_dropped)
         stats[f'{Prefix}/Critic Value'] = self.critic_exp_mvg_avg_high_level.item()
         for k in infos.keys():
             stats.update(create_stats_ordered_dict(
                 Prefix+k,
-                infos[k]
+                torch.cat(infos[k]).cpu().numpy()
             ))
 
         return stats
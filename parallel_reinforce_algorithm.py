@@ -1,23 +1,14 @@
 import argparse
 import os
-from random import random
-from re import L
-from unittest import result
-from sqlalchemy import all_
-from tqdm import tqdm 
 import torch
 import numpy as np
 import json 
 import copy 
-import os.path as osp
 import math
 import gtimer as gt
 from collections import OrderedDict
 
-import torch.optim as optim
-
 import torch.multiprocessing as mp
-import multiprocessing as python_mp
 
 from environments import SCIPCutSelEnv
 from cutsel_agent_parallel import CutSelectAgent, HierarchyCutSelectAgent
@@ -59,7 +50,7 @@ def generate_samples(return_queue,env,policy,value,epoch,samples_per_worker,sel_
     for step in range(samples_per_worker):
         logger.log(f"{log_prefix}: training...  epoch: {epoch}...  steps: {step+1}")
         logger.log(f"{log_prefix}: cuda memory: {torch.cuda.memory_allocated(0)/1024**3} GB")
-        logger.log(f"{log_prefix}: cuda cached: {torch.cuda.memory_cached(0)/1024**3} GB")
+        logger.log(f"{log_prefix}: cuda reserved: {torch.cuda.memory_reserved(0)/1024**3} GB")
         env.reset()
         # reset action agent
         cutsel_agent = CutSelectAgent(
@@ -130,7 +121,7 @@ def generate_hierarchy_samples(return_queue,env,policy,cutsel_policy,value,epoch
     for step in range(samples_per_worker):
         logger.log(f"{log_prefix}: training...  epoch: {epoch}...  steps: {step+1}")
         logger.log(f"{log_prefix}: cuda memory: {torch.cuda.memory_allocated(0)/1024**3} GB")
-        logger.log(f"{log_prefix}: cuda cached: {torch.cuda.memory_cached(0)/1024**3} GB")
+        logger.log(f"{log_prefix}: cuda reserved: {torch.cuda.memory_reserved(0)/1024**3} GB")
         env.reset()
         # reset action agent
         cutsel_agent = HierarchyCutSelectAgent(
@@ -612,6 +603,33 @@ def online_process_and_log_results(raw_results, epoch, test_type):
 
     return stats
 
+def start_sampling(env,pointer_net,cutsel_percent_policy,value_net,epoch,samples_each_worker,sel_cuts_percent,worker_devices,n_jobs,train_decode_type,reward_type,seeds,mean_std,policy_type,random_seed):
+    # spawn sampling workers, the policy is pickled to them on start
+    return_queue = mp.SimpleQueue()
+    processes = []
+    for i, worker_device in enumerate(worker_devices):
+        for num in range(n_jobs):
+            s = seeds[num] + i
+            if cutsel_percent_policy is not None:
+                p = mp.Process(
+                    target=generate_hierarchy_samples,
+                    args=(return_queue,env,pointer_net,cutsel_percent_policy,value_net,epoch,samples_each_worker,sel_cuts_percent,worker_device,train_decode_type,reward_type,s,mean_std,policy_type,random_seed)
+                )
+            else:     
+                p = mp.Process(
+                    target=generate_samples,
+                    args=(return_queue,env,pointer_net,value_net,epoch,samples_each_worker,sel_cuts_percent,worker_device,train_decode_type,reward_type,s,mean_std,policy_type,random_seed)
+                )
+            p.start()
+            processes.append(p)
+    return return_queue, processes
+
+def collect_samples(return_queue, processes):
+    raw_results = [return_queue.get() for p in processes] # list of tuple
+    for p in processes:
+        p.join()
+    return raw_results
+
 def _get_epoch_timings():
     times_itrs = gt.get_times().stamps.itrs
     times = OrderedDict()
@@ -844,6 +862,7 @@ def main():
                 cutsel_percent_policy.load_state_dict(state_dict['cutsel_percent_net'])
         # train 函数
         alg_kwargs = all_kwargs['algorithm']
+        alg_kwargs['policy_type'] = args.policy_type
         if cutsel_percent_policy_kwargs['use_cutsel_percent_policy']:
             algorithm = HRLReinforceAlg(
                 env,
@@ -871,6 +890,12 @@ def main():
         else:
             mean_std = None
     
+        # overlap sampling of the next epoch with training (off-policy by one epoch)
+        async_sampling = trainer_kwargs.get('async_sampling', False)
+        pending_sampling = None
+        next_train_seeds = None
+        if not cutsel_percent_policy_kwargs['use_cutsel_percent_policy']:
+            cutsel_percent_policy = None
         gt.reset_root()
         test_stats = {}
         eva_stats = {}
@@ -890,7 +915,12 @@ def main():
             assert trainer_kwargs['samples_per_epoch'] % trainer_kwargs['n_jobs'] == 0
             samples_each_worker = int(trainer_kwargs['samples_per_epoch'] / trainer_kwargs['n_jobs'])
 
-            train_multiprocess_seeds = [np.random.randint(2 ** 30) for _ in range(trainer_kwargs['n_jobs'])]
+            if next_train_seeds is None:
+                train_multiprocess_seeds = [np.random.randint(2 ** 30) for _ in range(trainer_kwargs['n_jobs'])]
+            else:
+                # seeds the prefetched sampling of this epoch was started with
+                train_multiprocess_seeds = next_train_seeds
+                next_train_seeds = None
             eval_multiprocess_seeds = [np.random.randint(2 ** 30) for _ in range(trainer_kwargs['n_jobs'])]
             for i, s in enumerate(train_multiprocess_seeds):
                 logger.record_tabular(f'train {i+1}th process seed', s)
@@ -1011,26 +1041,14 @@ def main():
             ####################################################
             # sampling ........
             logger.log(f"training...  epoch: {epoch+1}")
-            return_queue = mp.SimpleQueue()
-            processes = []
-            for i, worker_device in enumerate(worker_devices):
-                for num in range(trainer_kwargs['n_jobs']):
-                    s = train_multiprocess_seeds[num] + i
-                    if cutsel_percent_policy_kwargs['use_cutsel_percent_policy']:
-                        p = mp.Process(
-                            target=generate_hierarchy_samples,
-                            args=(return_queue,env,pointer_net,cutsel_percent_policy,value_net,epoch+1,samples_each_worker,args.sel_cuts_percent,worker_device,alg_kwargs['train_decode_type'],alg_kwargs['reward_type'],s,mean_std,args.policy_type,seed)
-                        )
-                    else:     
-                        p = mp.Process(
-                            target=generate_samples,
-                            args=(return_queue,env,pointer_net,value_net,epoch+1,samples_each_worker,args.sel_cuts_percent,worker_device,alg_kwargs['train_decode_type'],alg_kwargs['reward_type'],s,mean_std,args.policy_type,seed)
-                        )
-                    p.start()
-                    processes.append(p)
-            raw_results = [return_queue.get() for p in processes] # list of tuple
-            for p in processes:
-                p.join()
+            if pending_sampling is None:
+                pending_sampling = start_sampling(env,pointer_net,cutsel_percent_policy,value_net,epoch+1,samples_each_worker,args.sel_cuts_percent,worker_devices,trainer_kwargs['n_jobs'],alg_kwargs['train_decode_type'],alg_kwargs['reward_type'],train_multiprocess_seeds,mean_std,args.policy_type,seed)
+            raw_results = collect_samples(*pending_sampling)
+            pending_sampling = None
+            if async_sampling and (epoch + 1) < alg_kwargs['num_epochs']:
+                # sample the next epoch with the current (one epoch stale) cpu policy while training on this one
+                next_train_seeds = [np.random.randint(2 ** 30) for _ in range(trainer_kwargs['n_jobs'])]
+                pending_sampling = start_sampling(env,copy.deepcopy(pointer_net),copy.deepcopy(cutsel_percent_policy),value_net,epoch+2,samples_each_worker,args.sel_cuts_percent,worker_devices,trainer_kwargs['n_jobs'],alg_kwargs['train_decode_type'],alg_kwargs['reward_type'],next_train_seeds,mean_std,args.policy_type,seed)
             gt.stamp('sampling data', unique=False)
 
             # training policy and value with data 
@@ -1044,8 +1062,6 @@ def main():
             if train_highlevel_stats:
                 logger.record_dict(train_highlevel_stats)
             algorithm.train(raw_results, epoch+1)
-            # 释放torch cuda 缓存
-            torch.cuda.empty_cache()    
             gt.stamp('training', unique=False)
 
             # log timing data
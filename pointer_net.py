@@ -5,6 +5,7 @@ from torch.autograd import Variable
 from torch.nn.parameter import Parameter
 import torch.nn.functional as F
 from torch.distributions import Normal
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import math
 import numpy as np
 
@@ -31,8 +32,19 @@ class Encoder(nn.Module):
 
         self.enc_init_state = (self.enc_init_hx, self.enc_init_cx)
 
-    def forward(self, x, hidden):
-        output, hidden = self.lstm(x, hidden)
+    def forward(self, x, hidden, lengths=None):
+        """
+        Args:
+            x: [sourceL x batch_size x input_dim]
+            lengths: optional cpu tensor [batch_size] of valid lengths when x is
+                zero padded, so that the final hidden state ignores the padding
+        """
+        if lengths is None:
+            output, hidden = self.lstm(x, hidden)
+            return output, hidden
+        packed_x = pack_padded_sequence(x, lengths, enforce_sorted=False)
+        packed_output, hidden = self.lstm(packed_x, hidden)
+        output, _ = pad_packed_sequence(packed_output, total_length=x.size(0))
         return output, hidden
     
     def init_hidden(self, hidden_dim):
@@ -201,6 +213,70 @@ class Decoder(nn.Module):
         sels = embedded_inputs[idxs, [i for i in range(batch_size)], :] 
         return sels, probs[:,idxs]
 
+    def batch_logprobs(self, decoder_input, embedded_inputs, hidden, context, valid_mask, max_decode_lens, seled_idxes):
+        """
+        Args:
+            embedded_inputs: zero padded inputs, [sourceL x batch_size x embedding_dim]
+            context: encoder outputs, [sourceL x batch_size x hidden_dim]
+            valid_mask: [batch_size x sourceL], False at padded positions
+            max_decode_lens: [batch_size] decoding steps of each sample
+            seled_idxes: [max decode len x batch_size] selected idxes, zero padded
+        Returns:
+            pointer probs [batch_size x max decode len x sourceL],
+            selected probs: list of [batch_size] tensors, one per decoding step
+        """
+        def recurrence(x, hidden, logit_mask):
+
+            hx, cx = hidden  # batch_size x hidden_dim
+
+            gates = self.input_weights(x) + self.hidden_weights(hx)
+            ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+
+            ingate = F.sigmoid(ingate)
+            forgetgate = F.sigmoid(forgetgate)
+            cellgate = F.tanh(cellgate)
+            outgate = F.sigmoid(outgate)
+
+            cy = (forgetgate * cx) + (ingate * cellgate)
+            hy = outgate * F.tanh(cy)  # batch_size x hidden_dim
+
+            g_l = hy
+            for i in range(self.n_glimpses):
+                ref, logits = self.glimpse(g_l, context)
+                logits = logits.masked_fill(logit_mask, -np.inf)
+                g_l = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2)
+            _, logits = self.pointer(g_l, context)
+
+            logits = logits.masked_fill(logit_mask, -np.inf)
+            probs = self.sm(logits)
+            return hy, cy, probs
+
+        batch_size = context.size(1)
+        batch_idxes = torch.arange(batch_size, device=context.device)
+        pad_mask = ~valid_mask
+        seled_mask = torch.zeros_like(pad_mask)
+        outputs = []
+        step_probs = []
+
+        for i in range(seled_idxes.size(0)):
+            # samples which have finished decoding keep only the padding mask,
+            # so that their (unused) distributions never become all -inf
+            active = i < max_decode_lens
+            logit_mask = pad_mask | (seled_mask & active.unsqueeze(1))
+            hx, cx, probs = recurrence(decoder_input, hidden, logit_mask)
+            hidden = (hx, cx)
+            idxs = seled_idxes[i]
+            prob = probs[batch_idxes, idxs]
+            # finished samples contribute log(1) = 0; clamping keeps log finite so that
+            # a dropped sample's zero gradient cannot turn into 0 * inf = nan
+            prob = prob.clamp_min(torch.finfo(prob.dtype).tiny)
+            step_probs.append(torch.where(active, prob, torch.ones_like(prob)))
+            decoder_input = embedded_inputs[idxs, batch_idxes, :]
+            seled_mask = seled_mask.scatter(1, idxs.unsqueeze(1), True)
+            outputs.append(probs)
+
+        return torch.stack(outputs, 1), step_probs
+
     def forward(self, decoder_input, embedded_inputs, hidden, context, max_length, decode_type): # TODO: max decode length 以参数传入forward 函数
         """
         Args:
@@ -454,10 +530,8 @@ class PointerNetwork(nn.Module):
         return pointer_probs, input_idxs
 
     def _prob_to_logp(self, prob):
-        logprob = 0
-        for p in prob:
-            logp = torch.log(p)
-            logprob += logp
+        # prob: list of [batch_size] tensors, one per decoding step
+        logprob = torch.log(torch.stack(list(prob))).sum(0)
         # TODO: 添加截断过小logprob 的trick 
         # logprob[(logprob < -10000).detach()] = 0.
         
@@ -491,6 +565,40 @@ class PointerNetwork(nn.Module):
         
         return [pointer_prob.cpu().detach() for pointer_prob in pointer_probs], logprob
 
+    def batch_logprobs(self, inputs, lengths, max_decode_lens, seled_idxes):
+        """ Propagate a zero padded minibatch through the network in one pass
+        Args:
+            inputs: [sourceL x batch_size x embedding_dim]
+            lengths: cpu tensor [batch_size], number of cuts of each sample
+            max_decode_lens: [batch_size], number of selected cuts of each sample
+            seled_idxes: [max decode len x batch_size]
+        """
+        valid_mask = torch.arange(inputs.size(0), device=inputs.device).unsqueeze(0) < lengths.to(inputs.device).unsqueeze(1)
+
+        (encoder_hx, encoder_cx) = self.encoder.enc_init_state
+        encoder_hx = encoder_hx.unsqueeze(0).repeat(inputs.size(1), 1).unsqueeze(0)
+        encoder_cx = encoder_cx.unsqueeze(0).repeat(inputs.size(1), 1).unsqueeze(0)
+
+        # encoder forward pass
+        enc_h, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx), lengths)
+
+        dec_init_state = (enc_h_t[-1], enc_c_t[-1])
+
+        # repeat decoder_in_0 across batch
+        decoder_input = self.decoder_in_0.unsqueeze(0).repeat(inputs.size(1), 1)
+
+        pointer_probs, step_probs = self.decoder.batch_logprobs(decoder_input,
+                inputs,
+                dec_init_state,
+                enc_h,
+                valid_mask,
+                max_decode_lens,
+                seled_idxes)
+
+        logprob = self._prob_to_logp(step_probs).unsqueeze(1)
+
+        return pointer_probs.detach(), logprob
+
 class CriticNetwork(nn.Module):
     """Useful as a baseline in REINFORCE updates"""
     def __init__(self,
@@ -568,10 +676,11 @@ class CutsPercentPolicy(nn.Module):
         )
         self.use_cuda = use_cuda
 
-    def forward(self, inputs):
+    def forward(self, inputs, lengths=None):
         """
         Args:
             inputs: [embedding_dim x batch_size x sourceL] of embedded inputs
+            lengths: optional cpu tensor [batch_size] of valid lengths when inputs are zero padded
         """
          
         (encoder_hx, encoder_cx) = self.encoder.enc_init_state
@@ -579,12 +688,16 @@ class CutsPercentPolicy(nn.Module):
         encoder_cx = encoder_cx.unsqueeze(0).repeat(inputs.size(1), 1).unsqueeze(0)       
         
         # encoder forward pass
-        enc_outputs, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx))
+        enc_outputs, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx), lengths)
+        if lengths is not None:
+            pad_mask = torch.arange(inputs.size(0), device=inputs.device).unsqueeze(0) >= lengths.to(inputs.device).unsqueeze(1)
         
         # grab the hidden state and process it via the process block 
         process_block_state = enc_h_t[-1]
         for i in range(self.n_process_block_iters):
             ref, logits = self.process_block(process_block_state, enc_outputs)
+            if lengths is not None:
+                logits = logits.masked_fill(pad_mask, -np.inf)
             process_block_state = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2)
         # produce the final scalar output
         out = self.decoder(process_block_state)
@@ -607,22 +720,22 @@ class CutsPercentPolicy(nn.Module):
 
         return tanh_action
 
-    def get_mean_std(self, states):
-        out = self.forward(states)
+    def get_mean_std(self, states, lengths=None):
+        out = self.forward(states, lengths)
         mean, log_std = torch.chunk(out,2,-1)
         log_std = torch.clamp(log_std, LOG_STD_MIN, LOG_STD_MAX)
         log_std = log_std.expand(mean.shape)
 
         return mean, log_std
 
-    def log_prob(self, states, action=None, pretanh_action=None):
+    def log_prob(self, states, action=None, pretanh_action=None, lengths=None):
         if pretanh_action is None:
             assert action is not None
             pretanh_action = torch.log((1+action)/(1-action) +1e-6) / 2
         else:
             assert pretanh_action is not None
             action = torch.tanh(pretanh_action)
-        mean, log_std = self.get_mean_std(states)
+        mean, log_std = self.get_mean_std(states, lengths)
         std = torch.exp(log_std)
         normal = Normal(mean, std)
         pre_log_prob = normal.log_prob(pretanh_action)
@@ -166,6 +166,70 @@ class DecoderEndToken(nn.Module):
         sels = embedded_inputs[idxs, [i for i in range(batch_size)], :] 
         return sels, probs[:,idxs]
 
+    def batch_logprobs(self, decoder_input, embedded_inputs, hidden, context, valid_mask, max_decode_lens, seled_idxes):
+        """
+        Args:
+            embedded_inputs: zero padded inputs, [sourceL x batch_size x embedding_dim]
+            context: encoder outputs, [sourceL x batch_size x hidden_dim]
+            valid_mask: [batch_size x sourceL], False at padded positions
+            max_decode_lens: [batch_size] decoding steps of each sample
+            seled_idxes: [max decode len x batch_size] selected idxes, zero padded
+        Returns:
+            pointer probs [batch_size x max decode len x sourceL],
+            selected probs: list of [batch_size] tensors, one per decoding step
+        """
+        def recurrence(x, hidden, logit_mask):
+
+            hx, cx = hidden  # batch_size x hidden_dim
+
+            gates = self.input_weights(x) + self.hidden_weights(hx)
+            ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+
+            ingate = F.sigmoid(ingate)
+            forgetgate = F.sigmoid(forgetgate)
+            cellgate = F.tanh(cellgate)
+            outgate = F.sigmoid(outgate)
+
+            cy = (forgetgate * cx) + (ingate * cellgate)
+            hy = outgate * F.tanh(cy)  # batch_size x hidden_dim
+
+            g_l = hy
+            for i in range(self.n_glimpses):
+                ref, logits = self.glimpse(g_l, context)
+                logits = logits.masked_fill(logit_mask, -np.inf)
+                g_l = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2)
+            _, logits = self.pointer(g_l, context)
+
+            logits = logits.masked_fill(logit_mask, -np.inf)
+            probs = self.sm(logits)
+            return hy, cy, probs
+
+        batch_size = context.size(1)
+        batch_idxes = torch.arange(batch_size, device=context.device)
+        pad_mask = ~valid_mask
+        seled_mask = torch.zeros_like(pad_mask)
+        outputs = []
+        step_probs = []
+
+        for i in range(seled_idxes.size(0)):
+            # samples which have finished decoding keep only the padding mask,
+            # so that their (unused) distributions never become all -inf
+            active = i < max_decode_lens
+            logit_mask = pad_mask | (seled_mask & active.unsqueeze(1))
+            hx, cx, probs = recurrence(decoder_input, hidden, logit_mask)
+            hidden = (hx, cx)
+            idxs = seled_idxes[i]
+            prob = probs[batch_idxes, idxs]
+            # finished samples contribute log(1) = 0; clamping keeps log finite so that
+            # a dropped sample's zero gradient cannot turn into 0 * inf = nan
+            prob = prob.clamp_min(torch.finfo(prob.dtype).tiny)
+            step_probs.append(torch.where(active, prob, torch.ones_like(prob)))
+            decoder_input = embedded_inputs[idxs, batch_idxes, :]
+            seled_mask = seled_mask.scatter(1, idxs.unsqueeze(1), True)
+            outputs.append(probs)
+
+        return torch.stack(outputs, 1), step_probs
+
     def forward(self, decoder_input, embedded_inputs, hidden, context, max_length, decode_type):
         """
         Args:
@@ -412,10 +476,8 @@ class PointerNetworkEndToken(nn.Module):
         return pointer_probs, input_idxs
 
     def _prob_to_logp(self, prob):
-        logprob = 0
-        for p in prob:
-            logp = torch.log(p)
-            logprob += logp
+        # prob: list of [batch_size] tensors, one per decoding step
+        logprob = torch.log(torch.stack(list(prob))).sum(0)
         # logprob[(logprob < -10000).detach()] = 0.
         
         return logprob
@@ -451,6 +513,45 @@ class PointerNetworkEndToken(nn.Module):
         
         return [pointer_prob.cpu().detach() for pointer_prob in pointer_probs], logprob
 
+    def batch_logprobs(self, inputs, lengths, max_decode_lens, seled_idxes):
+        """ Propagate a zero padded minibatch through the network in one pass
+        Args:
+            inputs: [sourceL x batch_size x embedding_dim]
+            lengths: cpu tensor [batch_size], number of cuts of each sample
+            max_decode_lens: [batch_size], number of selected idxes (with end token) of each sample
+            seled_idxes: [max decode len x batch_size]
+        """
+        # preprocess inputs: the end token of each sample follows its last cut
+        batch_idxes = torch.arange(inputs.shape[1], device=inputs.device)
+        inputs = torch.cat((inputs, torch.zeros_like(inputs[:1])), axis=0)
+        inputs[lengths.to(inputs.device), batch_idxes, :] = 1.
+        lengths = lengths + 1
+        valid_mask = torch.arange(inputs.size(0), device=inputs.device).unsqueeze(0) < lengths.to(inputs.device).unsqueeze(1)
+
+        (encoder_hx, encoder_cx) = self.encoder.enc_init_state
+        encoder_hx = encoder_hx.unsqueeze(0).repeat(inputs.size(1), 1).unsqueeze(0)
+        encoder_cx = encoder_cx.unsqueeze(0).repeat(inputs.size(1), 1).unsqueeze(0)
+
+        # encoder forward pass
+        enc_h, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx), lengths)
+
+        dec_init_state = (enc_h_t[-1], enc_c_t[-1])
+
+        # repeat decoder_in_0 across batch
+        decoder_input = self.decoder_in_0.unsqueeze(0).repeat(inputs.size(1), 1)
+
+        pointer_probs, step_probs = self.decoder.batch_logprobs(decoder_input,
+                inputs,
+                dec_init_state,
+                enc_h,
+                valid_mask,
+                max_decode_lens,
+                seled_idxes)
+
+        logprob = self._prob_to_logp(step_probs).unsqueeze(1)
+
+        return pointer_probs.detach(), logprob
+
 
     
 # test 
@@ -37,10 +37,11 @@ class CriticNetwork(nn.Module):
                 nn.Linear(hidden_dim, 1)
         )
 
-    def forward(self, inputs):
+    def forward(self, inputs, lengths=None):
         """
         Args:
             inputs: [embedding_dim x batch_size x sourceL] of embedded inputs
+            lengths: optional cpu tensor [batch_size] of valid lengths when inputs are zero padded
         """
          
         (encoder_hx, encoder_cx) = self.encoder.enc_init_state
@@ -48,12 +49,16 @@ class CriticNetwork(nn.Module):
         encoder_cx = encoder_cx.unsqueeze(0).repeat(inputs.size(1), 1).unsqueeze(0)       
         
         # encoder forward pass
-        enc_outputs, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx))
+        enc_outputs, (enc_h_t, enc_c_t) = self.encoder(inputs, (encoder_hx, encoder_cx), lengths)
+        if lengths is not None:
+            pad_mask = torch.arange(inputs.size(0), device=inputs.device).unsqueeze(0) >= lengths.to(inputs.device).unsqueeze(1)
         
         # grab the hidden state and process it via the process block 
         process_block_state = enc_h_t[-1]
         for i in range(self.n_process_block_iters):
             ref, logits = self.process_block(process_block_state, enc_outputs)
+            if lengths is not None:
+                logits = logits.masked_fill(pad_mask, -np.inf)
             process_block_state = torch.bmm(ref, self.sm(logits).unsqueeze(2)).squeeze(2)
         # produce the final scalar output
         out = self.decoder(process_block_state)